@@ -8,11 +8,16 @@ from logging import getLogger, StreamHandler, Formatter, NullHandler
 from logging import DEBUG
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, wait
 import hashlib
+import math
 import os
 import sqlite3
 import time
 
+from rate_limiter import RateLimiter
+
 
 InvalidPath = namedtuple('InvalidPath', ['path', 'reason'])
 
@@ -25,6 +30,11 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 SQLITE3_FILENAME = 'db.sqlite3'
 SQLITE3_PATH = os.path.join(BASE_DIR, SQLITE3_FILENAME)
 
+# scrub時に一度のread()で読み込むバイト数。IOPSの計算単位でもある
+SCRUB_CHUNK_SIZE = 1024 * 1024
+# 一度にDBから取り出す検証対象の行数
+SCRUB_BATCH_SIZE = 256
+
 
 def _human_readable_time(elapsed_sec):
     elapsed_int = int(elapsed_sec)
@@ -38,6 +48,199 @@ def _human_readable_time(elapsed_sec):
     return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 
+def _hash_file(path):
+    '''\
+    ファイル内容のsha256を計算する。
+    ProcessPoolExecutorから呼ばれるためモジュールのトップレベルに置く。
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SCRUB_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _init_scrub_state(conn, *, restart=False, logger=None):
+    '''\
+    スクラブの進捗 (カーソル) を保存するテーブルを用意し、
+    現在のパスの開始時刻を返す。
+
+    パスの開始時刻より前に検証された (または一度も検証されていない) 行が
+    そのパスの残りの検証対象となる。中断後に再実行した場合は
+    同じ開始時刻を使うので、未検証の行から再開される。
+    '''
+    logger = logger or _null_logger
+    c = conn.cursor()
+    c.execute('''\
+    CREATE TABLE IF NOT EXISTS
+    scrub_state (key text PRIMARY KEY, value text)
+    ''')
+    if restart:
+        logger.info('Discarding scrub cursor')
+        c.execute('DELETE FROM scrub_state')
+    state = dict(c.execute('SELECT key, value FROM scrub_state').fetchall())
+    if 'pass_started' in state:
+        pass_started = float(state['pass_started'])
+        logger.info('Resuming scrub pass started at {} ({} files verified,'
+                    ' last: "{}")'
+                    .format(time.ctime(pass_started),
+                            state.get('files_verified', 0),
+                            state.get('last_filename', '')))
+    else:
+        pass_started = time.time()
+        logger.info('Starting new scrub pass')
+        c.executemany('''\
+        INSERT OR REPLACE INTO scrub_state (key, value) VALUES (?, ?)
+        ''', [('pass_started', repr(pass_started)),
+              ('files_verified', '0')])
+    conn.commit()
+    return pass_started
+
+
+def scrub(conn, base_dir_path, *, workers=2, use_processes=False,
+          bytes_per_sec=0, iops=0, limit=0, restart=False, logger=None):
+    '''\
+    DBに記録されたファイルの内容を読み直し、保存されているsha256と比較する。
+
+    最後に検証されたのが古いものから順に処理する。
+    進捗はDBに保存されるため、中断しても次回は続きから再開される。
+    読み込み量はbytes_per_sec (バイト/秒) とiops (read()回数/秒) で
+    制限できる。0は無制限を意味する。
+
+    content_sha256を記録する前のwatchdog2_main.pyが書いた行は
+    比較せず、読み込んだ内容のsha256を保存する (バックフィル)。
+
+    (検証したファイル数, InvalidPathのリスト) を返す。
+    '''
+    logger = logger or _null_logger
+    c = conn.cursor()
+    columns = {row[1] for row in c.execute('PRAGMA table_info(files)')}
+    if 'content_sha256' not in columns:
+        raise RuntimeError('The DB has no content digest.'
+                           ' Run watchdog2_main.py against it first')
+    pass_started = _init_scrub_state(conn, restart=restart, logger=logger)
+    byte_limiter = RateLimiter(bytes_per_sec)
+    iops_limiter = RateLimiter(iops)
+    if use_processes:
+        executor_class = ProcessPoolExecutor
+    else:
+        executor_class = ThreadPoolExecutor
+    invalid_paths = []
+    total_files = 0
+    total_backfilled = 0
+    with executor_class(max_workers=workers) as executor:
+        while not limit or total_files < limit:
+            batch_size = SCRUB_BATCH_SIZE
+            if limit:
+                batch_size = min(batch_size, limit - total_files)
+            rows = c.execute('''\
+            SELECT filename, content_sha256 FROM files
+            WHERE verified_at IS NULL OR verified_at < ?
+            ORDER BY verified_at, filename
+            LIMIT ?
+            ''', (pass_started, batch_size)).fetchall()
+            if not rows:
+                logger.info('Scrub pass finished')
+                c.execute('DELETE FROM scrub_state')
+                conn.commit()
+                break
+            futures = {}
+            pending = set()
+            checked = []
+            backfilled = []
+            for (rel_path, expected) in rows:
+                file_path = os.path.join(base_dir_path, rel_path)
+                try:
+                    size = os.stat(file_path).st_size
+                except OSError:
+                    size = 0
+                byte_limiter.acquire(size)
+                iops_limiter.acquire(
+                    max(1, math.ceil(size / SCRUB_CHUNK_SIZE)))
+                # 同時に処理中のファイル数はワーカー数の倍までに抑える
+                if len(pending) >= workers * 2:
+                    (_, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                logger.debug('Scrubbing "{}"'.format(rel_path))
+                future = executor.submit(_hash_file, file_path)
+                futures[future] = (rel_path, expected)
+                pending.add(future)
+            for future in futures:
+                (rel_path, expected) = futures[future]
+                try:
+                    actual = future.result()
+                except FileNotFoundError:
+                    actual = None
+                    reason = 'File missing'
+                except OSError as e:
+                    actual = None
+                    reason = 'Failed to read ({})'.format(e)
+                else:
+                    if expected is None:
+                        logger.debug('Backfilling content digest of "{}"'
+                                     .format(rel_path))
+                        backfilled.append((actual, rel_path))
+                        reason = None
+                    elif actual == expected:
+                        reason = None
+                    else:
+                        reason = ('sha256 differs (expected: "{}",'
+                                  ' actual: "{}")'.format(expected, actual))
+                if reason:
+                    # 検証中にwatchdog2_main.pyがファイルと行を
+                    # 更新・削除していた場合は誤検知なので、行を読み直す
+                    rows_now = c.execute('''\
+                    SELECT content_sha256 FROM files WHERE filename = ?
+                    ''', (rel_path,)).fetchall()
+                    if not rows_now:
+                        logger.debug('"{}" was deleted during scrub'
+                                     .format(rel_path))
+                        reason = None
+                    elif rows_now[0][0] != expected:
+                        current = rows_now[0][0]
+                        logger.debug('"{}" was updated during scrub'
+                                     .format(rel_path))
+                        if actual == current:
+                            reason = None
+                        elif actual is not None:
+                            reason = ('sha256 differs (expected: "{}",'
+                                      ' actual: "{}")'
+                                      .format(current, actual))
+                if reason:
+                    logger.debug('"{}": {}'.format(rel_path, reason))
+                    invalid_paths.append(InvalidPath(rel_path, reason))
+                checked.append(rel_path)
+            # 検証中にwatchdog2_main.pyが行を更新していた場合、
+            # そちらのverified_atの方が新しいので上書きしない
+            now = time.time()
+            c.executemany('''\
+            UPDATE files SET verified_at = ?
+            WHERE filename = ? AND (verified_at IS NULL OR verified_at < ?)
+            ''', [(now, rel_path, pass_started) for rel_path in checked])
+            # こちらも検証中に行が更新されていた場合はそちらの値を優先する
+            c.executemany('''\
+            UPDATE files SET content_sha256 = ?
+            WHERE filename = ? AND content_sha256 IS NULL
+            ''', backfilled)
+            if backfilled:
+                logger.info('Backfilled content digest of {} file(s)'
+                            .format(len(backfilled)))
+            total_files += len(checked)
+            total_backfilled += len(backfilled)
+            c.execute('''\
+            UPDATE scrub_state SET value = value + ?
+            WHERE key = 'files_verified'
+            ''', (len(checked),))
+            c.execute('''\
+            INSERT OR REPLACE INTO scrub_state (key, value)
+            VALUES ('last_filename', ?)
+            ''', (rows[-1][0],))
+            conn.commit()
+    if total_backfilled:
+        logger.info('Backfilled content digest of {} file(s) in total'
+                    .format(total_backfilled))
+    return (total_files, invalid_paths)
+
+
 def main():
     parser = ArgumentParser(description=(__doc__),
                             formatter_class=RawDescriptionHelpFormatter)
@@ -49,6 +252,29 @@ def main():
                         help=('Path to watch'))
     parser.add_argument('-p', '--path-to-sqlite3', default=SQLITE3_PATH,
                         help=('Path to sqlite3 db'))
+    parser.add_argument('--scrub', action='store_true',
+                        help=('Re-read file contents and verify them'
+                              ' against content digests stored in the DB,'
+                              ' least-recently-verified first.'
+                              ' Progress is stored in the DB and resumed'
+                              ' on the next run'))
+    parser.add_argument('--scrub-workers', type=int, default=2,
+                        help=('Number of workers reading files'))
+    parser.add_argument('--scrub-processes', action='store_true',
+                        help=('Use a process pool instead of a thread pool'))
+    parser.add_argument('--scrub-bytes-per-sec', type=int,
+                        default=16 * 1024 * 1024,
+                        help=('Read budget in bytes/sec. 0 means unlimited'))
+    parser.add_argument('--scrub-iops', type=int, default=200,
+                        help=('Read budget in read() calls/sec'
+                              ' ({} bytes each). 0 means unlimited'
+                              .format(SCRUB_CHUNK_SIZE)))
+    parser.add_argument('--scrub-limit', type=int, default=0,
+                        help=('Max number of files to verify in this run.'
+                              ' 0 means until the current pass finishes'))
+    parser.add_argument('--scrub-restart', action='store_true',
+                        help=('Discard the stored cursor and start'
+                              ' a new pass'))
     args = parser.parse_args()
     logger = getLogger(__name__)
     handler = StreamHandler()
@@ -69,41 +295,59 @@ def main():
         logger.info('path_to_check: "{}"'.format(path_to_check))
         logger.info('path_to_sqlite3: "{}"'.format(path_to_sqlite3))
         started = time.time()
-        conn = sqlite3.connect(path_to_sqlite3)
+        # --scrub はwatchdog2_main.pyと同時に動かす前提なので
+        # ロック待ちを長めに取る
+        conn = sqlite3.connect(path_to_sqlite3, timeout=60)
         c = conn.cursor()
-        invalid_paths = []
-        total_files = 0
-        for (dirpath, dirnames, filenames) in os.walk(path_to_check):
-            for filename in filenames:
-                total_files += 1
-                file_path = os.path.join(dirpath, filename)
-                rel_path = os.path.relpath(file_path, path_to_check)
-                logger.debug('Checking "{}"'.format(rel_path))
-                rows = c.execute('''\
-                SELECT filename, sha1 FROM files
-                WHERE filename = ?
-                ''', (rel_path,)).fetchall()
-                assert len(rows) >= 0
-                if len(rows) == 0:
-                    reason = 'Row missing'
-                    logger.debug(reason)
-                    invalid_paths.append(InvalidPath(rel_path, reason))
-                    continue
-                elif len(rows) > 1:
-                    reason = 'Multiple ({}) rows found'.format(len(rows))
-                    logger.debug(reason)
-                    invalid_paths.append(InvalidPath(rel_path, reason))
-                    continue
-                (filename, actual_sha1) = rows[0][0], rows[0][1]
-                assert filename == rel_path
-                s = hashlib.sha1(rel_path.encode('utf-8'))
-                expected_sha1 = s.hexdigest()
-                if expected_sha1 != actual_sha1:
-                    reason = ('sha1 differs (expected: "{}", actual: "{}"'
-                              .format(expected_sha1, actual_sha1))
-                    logger.debug(reason)
-                    invalid_paths.append(InvalidPath(rel_path, reason))
-                    continue
+        if args.scrub:
+            logger.info('Scrubbing content (workers: {}, {} bytes/sec,'
+                        ' {} IOPS)'
+                        .format(args.scrub_workers,
+                                args.scrub_bytes_per_sec,
+                                args.scrub_iops))
+            (total_files, invalid_paths) = scrub(
+                conn, path_to_check,
+                workers=args.scrub_workers,
+                use_processes=args.scrub_processes,
+                bytes_per_sec=args.scrub_bytes_per_sec,
+                iops=args.scrub_iops,
+                limit=args.scrub_limit,
+                restart=args.scrub_restart,
+                logger=logger)
+        else:
+            invalid_paths = []
+            total_files = 0
+            for (dirpath, dirnames, filenames) in os.walk(path_to_check):
+                for filename in filenames:
+                    total_files += 1
+                    file_path = os.path.join(dirpath, filename)
+                    rel_path = os.path.relpath(file_path, path_to_check)
+                    logger.debug('Checking "{}"'.format(rel_path))
+                    rows = c.execute('''\
+                    SELECT filename, sha1 FROM files
+                    WHERE filename = ?
+                    ''', (rel_path,)).fetchall()
+                    assert len(rows) >= 0
+                    if len(rows) == 0:
+                        reason = 'Row missing'
+                        logger.debug(reason)
+                        invalid_paths.append(InvalidPath(rel_path, reason))
+                        continue
+                    elif len(rows) > 1:
+                        reason = 'Multiple ({}) rows found'.format(len(rows))
+                        logger.debug(reason)
+                        invalid_paths.append(InvalidPath(rel_path, reason))
+                        continue
+                    (filename, actual_sha1) = rows[0][0], rows[0][1]
+                    assert filename == rel_path
+                    s = hashlib.sha1(rel_path.encode('utf-8'))
+                    expected_sha1 = s.hexdigest()
+                    if expected_sha1 != actual_sha1:
+                        reason = ('sha1 differs (expected: "{}", actual: "{}"'
+                                  .format(expected_sha1, actual_sha1))
+                        logger.debug(reason)
+                        invalid_paths.append(InvalidPath(rel_path, reason))
+                        continue
         logger.info('{} files handled'.format(total_files))
         if invalid_paths:
             logger.error('{} item(s) look incorrect'
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Python3 のみで動作可能
+#
+
+'''\
+FSChangeHandlerとDBRecorderの間に置く、追記専用のイベントスプール。
+
+イベントはまずメモリ上のバッファに積まれ、別スレッドがsync_interval秒ごとに
+まとめてセグメントファイルへ書き込みfsyncする。
+記録が終わったイベントはack()され、全て記録済みになった連番の最大値
+(ウォーターマーク) がackedファイルに保存される。
+
+プロセスが落ちた場合、次回起動時のopen()でウォーターマークより後の
+イベントが返されるので、それを記録し直せば良い。
+全てのイベントが記録済みになったセグメントファイルは削除される。
+
+セグメントファイル内の各レコードは
+(ペイロード長, ペイロードのCRC32) のヘッダとJSONのペイロードからなる。
+最後のセグメントの末尾が書きかけで壊れていた場合は切り詰める。
+'''
+
+from logging import getLogger, NullHandler
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+_null_logger = getLogger(__name__)
+_null_logger.addHandler(NullHandler())
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+SYNC_INTERVAL = 0.1
+
+_HEADER = struct.Struct('>II')
+_SEGMENT_PREFIX = 'segment-'
+_SEGMENT_SUFFIX = '.spool'
+_ACKED_FILENAME = 'acked'
+
+
+def _encode_record(seq, op, path):
+    payload = json.dumps([seq, op, path]).encode('utf-8')
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_records(f):
+    '''\
+    ファイルからレコードを読み、(連番, 操作, パス, 次のオフセット) を返す。
+    壊れたレコードに出会ったところで止まる。
+    '''
+    while True:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        (length, checksum) = _HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        (seq, op, path) = json.loads(payload.decode('utf-8'))
+        yield (seq, op, path, f.tell())
+
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EventSpool(object):
+    def __init__(self, spool_dir, *, segment_size=SEGMENT_SIZE,
+                 sync_interval=SYNC_INTERVAL, logger=None):
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.logger = logger or _null_logger
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._next_seq = 1
+        # この連番までのイベントは全て記録済み
+        self._watermark = 0
+        self._saved_watermark = 0
+        # ウォーターマークより後でack済みの連番
+        self._acked = set()
+        # (最初の連番, パス) のリスト。最後の要素が書き込み中のセグメント
+        self._segments = []
+        self._segment_file = None
+        self._closing = False
+        self._thread = None
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.spool_dir, '{}{:020d}{}'.format(
+            _SEGMENT_PREFIX, first_seq, _SEGMENT_SUFFIX))
+
+    def open(self):
+        '''\
+        スプールを開き、記録し直す必要のあるイベントを
+        (連番, 操作, パス) のリストとして返す。
+        返されたイベントも記録が終わったらack()すること。
+        '''
+        logger = self.logger
+        os.makedirs(self.spool_dir, exist_ok=True)
+        acked_path = os.path.join(self.spool_dir, _ACKED_FILENAME)
+        if os.path.exists(acked_path):
+            with open(acked_path) as f:
+                self._watermark = int(f.read().strip() or 0)
+        self._saved_watermark = self._watermark
+        filenames = sorted(
+            filename for filename in os.listdir(self.spool_dir)
+            if filename.startswith(_SEGMENT_PREFIX)
+            and filename.endswith(_SEGMENT_SUFFIX))
+        pending = []
+        last_seq = self._watermark
+        for (i, filename) in enumerate(filenames):
+            path = os.path.join(self.spool_dir, filename)
+            first_seq = int(filename[len(_SEGMENT_PREFIX):
+                                     -len(_SEGMENT_SUFFIX)])
+            offset = 0
+            with open(path, 'rb') as f:
+                for (seq, op, event_path, offset) in _read_records(f):
+                    last_seq = max(last_seq, seq)
+                    if seq > self._watermark:
+                        pending.append((seq, op, event_path))
+                size = f.seek(0, os.SEEK_END)
+            # 作成直後か、最初のレコードの書き込み途中で落ちた。
+            # 途中のセグメントが先頭から読めない場合は壊れているので残す
+            if size == 0 or (offset == 0 and i == len(filenames) - 1):
+                logger.info('Removing empty segment "{}" ({} bytes)'
+                            .format(path, size))
+                os.unlink(path)
+                continue
+            self._segments.append((first_seq, path))
+            if offset == size:
+                continue
+            if i == len(filenames) - 1:
+                # 書き込み途中で落ちた。壊れた末尾を捨てる
+                logger.info('Truncating torn tail of "{}" ({} bytes)'
+                            .format(path, size - offset))
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+                    os.fsync(f.fileno())
+            else:
+                logger.warning('"{}" is corrupted after offset {}.'
+                               ' Events after it are lost;'
+                               ' a rescan may be needed'
+                               .format(path, offset))
+        # 壊れていて読めなかったイベントは待っても記録されないので
+        # 記録済みとみなす
+        replayed = {seq for (seq, _, _) in pending}
+        self._acked = (set(range(self._watermark + 1, last_seq + 1))
+                       - replayed)
+        self._advance_watermark()
+        self._next_seq = last_seq + 1
+        logger.info('Opened spool at "{}" ({} event(s) to replay)'
+                    .format(self.spool_dir, len(pending)))
+        self._thread = threading.Thread(target=self._run,
+                                        name='event-spool')
+        self._thread.daemon = True
+        self._thread.start()
+        return pending
+
+    def append(self, op, path):
+        '''\
+        イベントを追加し、その連番を返す。
+        ディスクへの書き込みは別スレッドで行うのでここではブロックしない。
+        '''
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._buffer.append(_encode_record(seq, op, path))
+            return seq
+
+    def ack(self, seq):
+        with self._cond:
+            if seq <= self._watermark:
+                return
+            self._acked.add(seq)
+            self._advance_watermark()
+
+    def _advance_watermark(self):
+        while self._watermark + 1 in self._acked:
+            self._watermark += 1
+            self._acked.remove(self._watermark)
+
+    def close(self):
+        '''\
+        残っているイベントを書き出してからスプールを閉じる。
+        '''
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._segment_file:
+            self._segment_file.close()
+            self._segment_file = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closing:
+                    self._cond.wait(self.sync_interval)
+                closing = self._closing
+            try:
+                self._flush()
+            except OSError:
+                self.logger.exception('Failed to flush the event spool')
+            if closing:
+                return
+
+    def _flush(self):
+        with self._cond:
+            (records, self._buffer) = (self._buffer, [])
+            next_seq = self._next_seq - len(records)
+            watermark = self._watermark
+        if records:
+            try:
+                self._write(records, next_seq)
+            except OSError:
+                # 次の周期で書き直せるようバッファの先頭に戻す
+                with self._cond:
+                    self._buffer[:0] = records
+                raise
+        # レコードをfsyncした後でウォーターマークを保存する
+        if watermark != self._saved_watermark:
+            self._save_watermark(watermark)
+            self._compact(watermark)
+
+    def _write(self, records, first_seq):
+        if (self._segment_file
+                and self._segment_file.tell() >= self.segment_size):
+            self._segment_file.close()
+            self._segment_file = None
+        if self._segment_file is None:
+            path = self._segment_path(first_seq)
+            # 書き込みに失敗したときに書きかけのバイトが
+            # バッファに残らないようにバッファリングしない
+            self._segment_file = open(path, 'ab', buffering=0)
+            if not self._segments or self._segments[-1][1] != path:
+                self._segments.append((first_seq, path))
+            _fsync_dir(self.spool_dir)
+        offset = self._segment_file.tell()
+        try:
+            data = memoryview(b''.join(records))
+            while data:
+                data = data[self._segment_file.write(data):]
+            os.fsync(self._segment_file.fileno())
+        except OSError:
+            self._discard_torn_write(offset)
+            raise
+
+    def _discard_torn_write(self, offset):
+        '''\
+        書き込みに失敗したレコードをセグメントから取り除く。
+        壊れたレコードの後ろに次のレコードを書くと、
+        open()がそこで読むのをやめて後ろを捨ててしまうため。
+        '''
+        try:
+            self._segment_file.truncate(offset)
+            self._segment_file.seek(offset)
+            os.fsync(self._segment_file.fileno())
+        except OSError:
+            # 切り詰められない場合は次の書き込みで新しいセグメントを作る
+            self.logger.exception('Failed to truncate "{}" to offset {}'
+                                  .format(self._segment_file.name, offset))
+            self._segment_file.close()
+            self._segment_file = None
+
+    def _save_watermark(self, watermark):
+        path = os.path.join(self.spool_dir, _ACKED_FILENAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{}\n'.format(watermark))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.spool_dir)
+        self._saved_watermark = watermark
+
+    def _compact(self, watermark):
+        # 次のセグメントの最初の連番より前が全て記録済みなら
+        # そのセグメントは不要。書き込み中のセグメントは残す
+        while (len(self._segments) > 1
+               and self._segments[1][0] - 1 <= watermark):
+            (_, path) = self._segments.pop(0)
+            self.logger.debug('Removing completed segment "{}"'
+                              .format(path))
+            os.unlink(path)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# Python3 のみで動作可能
+#
+
+'''\
+watchdog2_main.py が記録したDBを他のサービスから参照するための
+ルックアップサーバ。
+
+ローカルのunixソケットかTCPでHTTPを話す。
+
+* GET /lookup?path=<相対パス> ひとつのパスを引く
+* POST /lookup ({"paths": [...]}) 複数のパスをまとめて引く
+* GET /list?prefix=<接頭辞>&after=<相対パス>&limit=<件数>
+  接頭辞に一致するパスを名前順に列挙する
+
+読み込みはWALモードのDBに対する読み込み専用コネクションのプールから行うため、
+DBRecorderの書き込みを待たせない。
+パスごとの結果はLRUキャッシュに保持し、DBRecorderが書き込み時に更新する。
+'''
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from logging import getLogger, NullHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import pathname2url
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+from unix_socket import remove_stale_socket
+
+_null_logger = getLogger(__name__)
+_null_logger.addHandler(NullHandler())
+
+# 一度のSELECTで指定するパスの数 (SQLITE_MAX_VARIABLE_NUMBER 未満にする)
+LOOKUP_BATCH_SIZE = 500
+LIST_DEFAULT_LIMIT = 1000
+LIST_MAX_LIMIT = 10000
+# POST /lookup で受け付けるリクエストボディの最大バイト数
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+
+def _make_record(path, row):
+    if row is None:
+        return {'path': path, 'recorded': False}
+    return {'path': path, 'recorded': True,
+            'sha1': row[0], 'content_sha256': row[1]}
+
+
+class LRUCache(object):
+    '''\
+    パスごとのレコードを保持するLRUキャッシュ。
+
+    put()は書き込み側 (DBRecorder) が使い、常に値を上書きする。
+    fill()は読み込み側が使い、DBを読み始めてから書き込みがあった場合は
+    古い値でキャッシュを上書きしないよう何もしない。
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        '''\
+        (キャッシュにあったかどうか, 値) を返す。
+        '''
+        with self._lock:
+            if key not in self._entries:
+                return (False, None)
+            self._entries.move_to_end(key)
+            return (True, self._entries[key])
+
+    def put(self, key, value):
+        with self._lock:
+            self._version += 1
+            self._store(key, value)
+
+    def fill(self, key, value, version):
+        with self._lock:
+            if self._version != version or key in self._entries:
+                return
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+class ReadOnlyConnectionPool(object):
+    '''\
+    読み込み専用のsqlite3コネクションのプール。
+
+    コネクションは同時に1スレッドでしか使われないため
+    check_same_thread=Falseでスレッド間で使い回す。
+    '''
+    def __init__(self, db_path, size):
+        uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_path)))
+        self._connections = queue.Queue()
+        for i in range(size):
+            self._connections.put(sqlite3.connect(uri, uri=True,
+                                                  check_same_thread=False))
+
+    def execute(self, sql, parameters=()):
+        conn = self._connections.get()
+        try:
+            return conn.execute(sql, parameters).fetchall()
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get().close()
+
+
+class LookupService(object):
+    def __init__(self, db_path, *, cache_size=10000, pool_size=4,
+                 logger=None):
+        self.logger = logger or _null_logger
+        self.cache = LRUCache(cache_size)
+        self.pool = ReadOnlyConnectionPool(db_path, pool_size)
+
+    def lookup(self, path):
+        return self.lookup_many([path])[0]
+
+    def lookup_many(self, paths):
+        records = {}
+        missing = []
+        for path in paths:
+            (hit, record) = self.cache.get(path)
+            if hit:
+                records[path] = record
+            else:
+                missing.append(path)
+        self.logger.debug('Looking up {} path(s) ({} cache miss(es))'
+                          .format(len(paths), len(missing)))
+        for i in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = list(set(missing[i:i + LOOKUP_BATCH_SIZE]))
+            version = self.cache.version()
+            rows = self.pool.execute('''\
+            SELECT filename, sha1, content_sha256 FROM files
+            WHERE filename IN ({})
+            '''.format(', '.join('?' * len(batch))), batch)
+            found = {row[0]: row[1:] for row in rows}
+            for path in batch:
+                record = _make_record(path, found.get(path))
+                self.cache.fill(path, record, version)
+                records[path] = record
+        return [records[path] for path in paths]
+
+    def list_prefix(self, prefix, *, after=None, limit=LIST_DEFAULT_LIMIT):
+        '''\
+        prefixで始まるパスを名前順に最大limit件返す。
+        afterを指定するとそれより後のパスから返す (ページング用)。
+        '''
+        if after is not None and after >= prefix:
+            (op, lower) = ('>', after)
+        else:
+            (op, lower) = ('>=', prefix)
+        # 範囲検索にしてfiles_indexを使わせる。U+10FFFFはUTF-8で最大の文字
+        rows = self.pool.execute('''\
+        SELECT filename, sha1, content_sha256 FROM files
+        WHERE filename {} ? AND filename < ?
+        ORDER BY filename
+        LIMIT ?
+        '''.format(op), (lower, prefix + '\U0010ffff', limit))
+        return [_make_record(row[0], row[1:]) for row in rows]
+
+    def record_inserted(self, path, sha1, content_sha256):
+        self.cache.put(path, _make_record(path, (sha1, content_sha256)))
+
+    def record_deleted(self, path):
+        self.cache.put(path, _make_record(path, None))
+
+    def close(self):
+        self.pool.close()
+
+
+class _LookupRequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # unixソケットの場合client_addressは空文字列になる
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        self.server.service.logger.debug('{} - {}'.format(
+            self.address_string(), format % args))
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/lookup':
+            if 'path' not in params:
+                self._send_json(400, {'error': '"path" is required'})
+                return
+            self._send_json(200, service.lookup(params['path'][0]))
+        elif url.path == '/list':
+            try:
+                limit = int(params.get('limit', [LIST_DEFAULT_LIMIT])[0])
+            except ValueError:
+                self._send_json(400, {'error': '"limit" must be an integer'})
+                return
+            records = service.list_prefix(
+                params.get('prefix', [''])[0],
+                after=params.get('after', [None])[0],
+                limit=max(0, min(limit, LIST_MAX_LIMIT)))
+            self._send_json(200, {'records': records})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        service = self.server.service
+        if urlsplit(self.path).path != '/lookup':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            # 負の値ではrfile.read()がクライアントが閉じるまで待ってしまう
+            if length < 0:
+                raise ValueError('negative Content-Length')
+            if length > MAX_REQUEST_BYTES:
+                self._send_json(413, {'error': 'Request body too large'})
+                return
+            body = self.rfile.read(length).decode('utf-8')
+            paths = json.loads(body)['paths']
+            if (not isinstance(paths, list)
+                    or not all(isinstance(p, str) for p in paths)):
+                raise ValueError('"paths" must be a list of strings')
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': 'Invalid request ({})'.format(e)})
+            return
+        self._send_json(200, {'records': service.lookup_many(paths)})
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, address, *, logger=None):
+    '''\
+    別スレッドでルックアップサーバを起動し、サーバオブジェクトを返す。
+    停止するにはshutdown()とserver_close()を呼ぶ。
+
+    addressは "unix:/path/to/socket" または "host:port" 形式。
+    unixソケットのパスが使用中の場合はRuntimeErrorを送出する
+    '''
+    logger = logger or service.logger
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        remove_stale_socket(socket_path)
+        server = _ThreadingUnixHTTPServer(socket_path, _LookupRequestHandler)
+    else:
+        (host, _, port) = address.rpartition(':')
+        server = _ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                      _LookupRequestHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever,
+                              name='lookup-server')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving lookups at "{}"'.format(address))
+    return server
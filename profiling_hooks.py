@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# Python3 のみで動作可能
+#
+
+'''\
+動作中のwatchdog_main.py / watchdog2_main.py を再起動せずに
+プロファイルするためのフック。
+
+* SIGUSR1: 全スレッドのスタックを書き出し、profile_sec秒間cProfileで計測する
+* SIGUSR2: tracemallocのスナップショットを取り、前回との差分を書き出す
+  (初回はtracemallocを開始するだけ)
+
+unixソケットを指定した場合は、1行のコマンドでも同じことができる。
+
+    $ echo 'profile 10' | nc -U /tmp/watchdog2-control.sock
+
+コマンドは "profile [秒数]", "memory", "memory stop", "stacks"。
+結果はoutput_dir以下のファイルに書き出され、そのパスが返される。
+
+Python 3.11以前のcProfileはスレッドごとにしか有効にできないため、
+wrap_methods()で指定したメソッドの呼び出しだけを計測する。
+計測していない間は属性をひとつ確認するだけで元のメソッドを呼ぶ。
+3.12以降はsys.monitoringにより全スレッドがまとめて計測されるので、
+wrap_methods()は何もしない。
+'''
+
+from logging import getLogger, NullHandler
+from socketserver import StreamRequestHandler, UnixStreamServer
+
+import cProfile
+import functools
+import io
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from unix_socket import remove_stale_socket
+
+_null_logger = getLogger(__name__)
+_null_logger.addHandler(NullHandler())
+
+# プロファイル結果のうちテキストで書き出す関数の数
+PROFILE_TOP_FUNCTIONS = 50
+# 計測終了時に実行中の呼び出しの完了を待つ最大秒数
+PROFILE_DRAIN_SEC = 5.0
+# 3.12以降のcProfileは有効にしたスレッド以外も計測し、
+# 同時に複数のProfileを有効にできない
+_PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class _ProfileWindow(object):
+    '''\
+    cProfileで計測している期間ひとつ分の状態。
+    スレッドごとにcProfile.Profileを持つ。
+    '''
+    def __init__(self):
+        self.profilers = {}
+        self.active_calls = 0
+        self.cond = threading.Condition()
+
+    def enter(self):
+        with self.cond:
+            self.active_calls += 1
+            ident = threading.get_ident()
+            if ident not in self.profilers:
+                self.profilers[ident] = cProfile.Profile()
+            return self.profilers[ident]
+
+    def leave(self):
+        with self.cond:
+            self.active_calls -= 1
+            self.cond.notify_all()
+
+    def drain(self, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.active_calls == 0, timeout)
+
+
+class ProfilingHooks(object):
+    def __init__(self, output_dir, *, profile_sec=30,
+                 top_allocations=25, logger=None):
+        self.output_dir = os.path.abspath(output_dir)
+        self.profile_sec = profile_sec
+        self.top_allocations = top_allocations
+        self.logger = logger or _null_logger
+        self._window = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._control_server = None
+        # 同じ秒に複数回書き出しても上書きしないための通し番号
+        self._sequence = itertools.count(1)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def _output_path(self, kind, ext):
+        filename = '{}-{}-{}-{}.{}'.format(
+            kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'),
+            next(self._sequence), ext)
+        return os.path.join(self.output_dir, filename)
+
+    def wrap(self, func):
+        if _PROFILE_ALL_THREADS:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            window = self._window
+            if window is None or getattr(self._local, 'profiling', False):
+                return func(*args, **kwargs)
+            profiler = window.enter()
+            self._local.profiling = True
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                self._local.profiling = False
+                window.leave()
+        return wrapper
+
+    def wrap_methods(self, obj, *names):
+        '''\
+        objのメソッドを計測対象にする。インスタンスの属性として上書きする
+        '''
+        for name in names:
+            setattr(obj, name, self.wrap(getattr(obj, name)))
+
+    def install_signal_handlers(self):
+        # Windowsなどには存在しない
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._on_sigusr1)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, self._on_sigusr2)
+
+    def _on_sigusr1(self, signum, frame):
+        # シグナルハンドラ内では重い処理をしない
+        self._run_in_thread(self.dump_stacks)
+        self._run_in_thread(self.start_profile)
+
+    def _on_sigusr2(self, signum, frame):
+        self._run_in_thread(self.snapshot_memory)
+
+    def _run_in_thread(self, func, *args):
+        thread = threading.Thread(target=func, args=args,
+                                  name='profiling-hooks')
+        thread.daemon = True
+        thread.start()
+
+    def start_profile(self, profile_sec=None):
+        '''\
+        profile_sec秒間の計測を開始し、結果を書き出すファイルのパスを返す。
+        既に計測中の場合はNoneを返す。
+        '''
+        profile_sec = profile_sec or self.profile_sec
+        with self._lock:
+            if self._window is not None:
+                self.logger.info('Profiling is already running')
+                return None
+            self._window = _ProfileWindow()
+            if _PROFILE_ALL_THREADS:
+                profiler = cProfile.Profile()
+                self._window.profilers[threading.get_ident()] = profiler
+                profiler.enable()
+        path = self._output_path('profile', 'pstats')
+        self.logger.info('Profiling for {} sec. Output: "{}"'
+                         .format(profile_sec, path))
+        timer = threading.Timer(profile_sec, self._finish_profile, (path,))
+        timer.daemon = True
+        timer.start()
+        return path
+
+    def _finish_profile(self, path):
+        with self._lock:
+            window = self._window
+            self._window = None
+        if _PROFILE_ALL_THREADS:
+            for profiler in window.profilers.values():
+                profiler.disable()
+        window.drain(PROFILE_DRAIN_SEC)
+        if not window.profilers:
+            self.logger.info('No profiled call was made')
+            return
+        stats = pstats.Stats(*window.profilers.values())
+        stats.dump_stats(path)
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        with open(os.path.splitext(path)[0] + '.txt', 'w') as f:
+            f.write(text.getvalue())
+        self.logger.info('Wrote profile to "{}"'.format(path))
+
+    def snapshot_memory(self):
+        '''\
+        tracemallocのスナップショットを取り、前回からの差分を書き出す。
+        書き出したファイルのパスを返す。
+        tracemallocが動いていない場合は開始するだけでNoneを返す。
+        '''
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                self.logger.info('Started tracemalloc')
+                tracemalloc.start()
+            if self._snapshot is None:
+                self._snapshot = tracemalloc.take_snapshot()
+                return None
+            previous = self._snapshot
+            snapshot = tracemalloc.take_snapshot()
+            self._snapshot = snapshot
+        path = self._output_path('memory', 'txt')
+        with open(path, 'w') as f:
+            (current, peak) = tracemalloc.get_traced_memory()
+            f.write('Traced memory: current {} bytes, peak {} bytes\n\n'
+                    .format(current, peak))
+            f.write('Top {} differences from the previous snapshot\n'
+                    .format(self.top_allocations))
+            for stat in snapshot.compare_to(previous, 'lineno')[
+                    :self.top_allocations]:
+                f.write('{}\n'.format(stat))
+            f.write('\nTop {} allocations\n'.format(self.top_allocations))
+            for stat in snapshot.statistics('lineno')[:self.top_allocations]:
+                f.write('{}\n'.format(stat))
+        self.logger.info('Wrote memory snapshot to "{}"'.format(path))
+        return path
+
+    def stop_memory(self):
+        with self._lock:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                self.logger.info('Stopped tracemalloc')
+            self._snapshot = None
+
+    def dump_stacks(self):
+        '''\
+        全スレッドのスタックを書き出し、そのパスを返す。
+        '''
+        path = self._output_path('stacks', 'txt')
+        names = {thread.ident: thread.name
+                 for thread in threading.enumerate()}
+        with open(path, 'w') as f:
+            for (ident, frame) in sys._current_frames().items():
+                f.write('Thread {} ({})\n'.format(
+                    ident, names.get(ident, 'unknown')))
+                f.write(''.join(traceback.format_stack(frame)))
+                f.write('\n')
+        self.logger.info('Wrote thread stacks to "{}"'.format(path))
+        return path
+
+    def serve_control(self, socket_path):
+        '''\
+        コマンドを受け付けるunixソケットを別スレッドで開く。
+        socket_pathが使用中の場合はRuntimeErrorを送出する。
+        '''
+        remove_stale_socket(socket_path)
+        server = UnixStreamServer(socket_path, _ControlRequestHandler)
+        server.hooks = self
+        self._control_server = server
+        self._run_in_thread(server.serve_forever)
+        self.logger.info('Accepting profiling commands at "{}"'
+                         .format(socket_path))
+
+    def close(self):
+        if self._control_server:
+            self._control_server.shutdown()
+            self._control_server.server_close()
+            os.unlink(self._control_server.server_address)
+            self._control_server = None
+
+    def handle_command(self, line):
+        '''\
+        コマンドを実行し、クライアントへ返す文字列を返す。
+        '''
+        words = line.split()
+        if not words:
+            return 'error: empty command'
+        if words[0] == 'profile':
+            try:
+                profile_sec = float(words[1]) if len(words) > 1 else None
+            except ValueError:
+                return 'error: invalid seconds "{}"'.format(words[1])
+            path = self.start_profile(profile_sec)
+            return path if path else 'error: already profiling'
+        elif words[0] == 'memory':
+            if words[1:] == ['stop']:
+                self.stop_memory()
+                return 'stopped'
+            return self.snapshot_memory() or 'started'
+        elif words[0] == 'stacks':
+            return self.dump_stacks()
+        return 'error: unknown command "{}"'.format(words[0])
+
+
+class _ControlRequestHandler(StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8')
+        result = self.server.hooks.handle_command(line)
+        self.wfile.write('{}\n'.format(result).encode('utf-8'))
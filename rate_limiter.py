@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Python3 のみで動作可能
+#
+
+'''\
+confirm_db.py の --scrub と watchdog2_main.py の large レーンで使う
+読み込み量の制限。
+'''
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    '''\
+    スレッドセーフなトークンバケット。rateが0以下の場合は制限しない。
+    '''
+    def __init__(self, rate, *, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # 予算を先に借りておき、不足分だけ待つ。
+            # バケットより大きい要求 (巨大ファイル) もこれで扱える
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
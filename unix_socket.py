@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Python3 のみで動作可能
+#
+
+'''\
+lookup_server.py と profiling_hooks.py で使う、unixソケットのパスの後始末。
+'''
+
+import os
+import socket
+import stat
+
+
+def remove_stale_socket(socket_path):
+    '''\
+    前回のプロセスが残したunixソケットがsocket_pathにあれば削除する。
+
+    ソケット以外のファイルがある場合や、別のプロセスが使用中のソケットの
+    場合は削除せずにRuntimeErrorを送出する。
+    '''
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError('"{}" exists and is not a socket'
+                           .format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except ConnectionRefusedError:
+        # 誰もlistenしていない
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError('"{}" is in use by another process'
+                       .format(socket_path))
@@ -11,20 +11,30 @@ Watchdog demo. Requires watchdog library.
 指定されたディレクトリを監視し、新たに追加されたファイルの内
 特定の拡張子を持つものを対象にして監視ディレクトリから見た
 ファイルの相対パスとsha1のhexdigestをsqlite3 DBに保存する。
+ファイル内容のsha256も合わせて保存し、confirm_db.py --scrub での検証に用いる。
 '''
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from logging import getLogger, StreamHandler, Formatter, NullHandler
 from logging import DEBUG
 
+from collections import deque, namedtuple
+import functools
 import hashlib
+import json
 import sqlite3
+import threading
 import time
 import os
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
+from event_spool import EventSpool, SEGMENT_SIZE, SYNC_INTERVAL
+from lookup_server import LookupService, serve
+from profiling_hooks import ProfilingHooks
+from rate_limiter import RateLimiter
+
 _null_logger = getLogger(__name__)
 _null_logger.addHandler(NullHandler())
 
@@ -37,6 +47,26 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 SQLITE3_FILENAME = 'db.sqlite3'
 SQLITE3_PATH = os.path.join(BASE_DIR, SQLITE3_FILENAME)
 
+# ファイル内容のダイジェストを計算する際に一度に読み込むバイト数
+DIGEST_CHUNK_SIZE = 64 * 1024
+# 大きいファイル用のレーンで一度に読み込むバイト数。
+# このサイズごとに小さいファイルへ処理を譲るかどうかを判断する
+LARGE_DIGEST_CHUNK_SIZE = 1024 * 1024
+# このサイズ以上のファイルは大きいファイル用のレーンで処理する
+LARGE_FILE_THRESHOLD = 16 * 1024 * 1024
+
+
+def _calc_digest(path, logger=None):
+    logger = logger or _null_logger
+    logger.debug('Start calculating hexdigest for {}'.format(path))
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            h.update(chunk)
+    logger.debug('Finished calculating hexdigest for {}'
+                 .format(path))
+    return h.hexdigest()
+
 
 class DBRecorder(object):
     def __init__(self, db_path, base_dir_path,
@@ -44,9 +74,16 @@ class DBRecorder(object):
         self.db_path = os.path.abspath(db_path)
         self.base_dir_path = base_dir_path
         self.logger = logger or _null_logger
+        # 設定されている場合、書き込みのたびにキャッシュを更新する
+        # (lookup_server.LookupService)
+        self.lookup_service = None
+        logger = self.logger
         logger.info('Init DB at "{}"'.format(self.db_path))
         conn = self._connect()
         c = conn.cursor()
+        # 読み込み側 (lookup_server.py) が書き込みを待たせないようにWALにする。
+        # この設定はDBファイルに保存される
+        c.execute('PRAGMA journal_mode=WAL')
         if drop_table:
             logger.info('Drop table at first')
             c.execute('''\
@@ -54,12 +91,26 @@ class DBRecorder(object):
             ''')
         c.execute('''\
         CREATE TABLE IF NOT EXISTS
-        files (filename text, sha1 text)
+        files (filename text, sha1 text,
+               content_sha256 text, verified_at real)
         ''')
+        # 旧バージョンで作成されたDBにはファイル内容のダイジェストを
+        # 保存するカラムが存在しないため、ここで追加する。
+        columns = {row[1] for row in c.execute('PRAGMA table_info(files)')}
+        for (column, column_type) in [('content_sha256', 'text'),
+                                      ('verified_at', 'real')]:
+            if column not in columns:
+                logger.info('Adding column "{}" to files'.format(column))
+                c.execute('ALTER TABLE files ADD COLUMN {} {}'
+                          .format(column, column_type))
         c.execute('''\
         CREATE UNIQUE INDEX IF NOT EXISTS
         files_index ON files (filename)
         ''')
+        c.execute('''\
+        CREATE INDEX IF NOT EXISTS
+        files_verified_at_index ON files (verified_at)
+        ''')
         conn.commit()
         logger.info('Init db finished')
 
@@ -75,7 +126,7 @@ class DBRecorder(object):
         '''
         # 標準のisolation_levelもDEFERREDのはずだが明文化されていない
         # 明示しておく。
-        return sqlite3.connect(SQLITE3_PATH,
+        return sqlite3.connect(self.db_path,
                                isolation_level='DEFERRED')
 
     def print_content_to_logger(self, *, logger=None):
@@ -88,7 +139,12 @@ class DBRecorder(object):
                         .format(row[0], row[1]))
         logger.info('Showed all entries in db')
 
-    def insert(self, path, *, logger=None):
+    def insert(self, path, *, content_digest=None, logger=None):
+        '''\
+        ファイルを記録する。
+        content_digestが指定されていない場合はここでファイル内容の
+        ダイジェストを計算する。
+        '''
         logger = logger or self.logger
         if os.path.abspath(path) == self.db_path:
             logger.debug(
@@ -98,16 +154,28 @@ class DBRecorder(object):
         rel_path = os.path.relpath(os.path.abspath(path),
                                    self.base_dir_path)
         sha1digest = hashlib.sha1(rel_path.encode('utf-8')).hexdigest()
-        logger.info('Saving "{}" with sha1 "{}"'
-                    .format(rel_path, sha1digest))
+        if content_digest is None:
+            try:
+                content_digest = _calc_digest(path, logger=logger)
+            except OSError as e:
+                # 記録前にファイルが削除された場合など。
+                # 削除イベントが後から届くはずなのでダイジェストなしで記録する
+                logger.info('Failed to calculate content digest of "{}"'
+                            ' Maybe already deleted? ({})'
+                            .format(rel_path, e))
+        logger.info('Saving "{}" with sha1 "{}" (sha256: {})'
+                    .format(rel_path, sha1digest, content_digest))
         conn = self._connect()
         c = conn.cursor()
         c.execute('''\
         INSERT OR REPLACE INTO files
-        (filename, sha1)
-        VALUES (?, ?)
-        ''', (rel_path, sha1digest))
+        (filename, sha1, content_sha256, verified_at)
+        VALUES (?, ?, ?, ?)
+        ''', (rel_path, sha1digest, content_digest, time.time()))
         conn.commit()
+        if self.lookup_service:
+            self.lookup_service.record_inserted(rel_path, sha1digest,
+                                                content_digest)
 
     def delete(self, path, *, logger=None):
         logger = logger or self.logger
@@ -124,14 +192,307 @@ class DBRecorder(object):
         c.execute('DELETE FROM files WHERE (filename = ?)',
                   (rel_path,))
         conn.commit()
+        if self.lookup_service:
+            self.lookup_service.record_deleted(rel_path)
+
+
+WorkItem = namedtuple('WorkItem', ['op', 'path', 'generation', 'enqueued',
+                                   'on_done', 'attempt'])
+
+
+class _Lane(object):
+    def __init__(self, name, num_workers, *, bytes_per_sec=0):
+        self.name = name
+        self.num_workers = num_workers
+        self.queue = deque()
+        self.limiter = RateLimiter(bytes_per_sec)
+        self.threads = []
+
+
+class LaneScheduler(object):
+    '''\
+    記録処理をファイルサイズに応じたレーンに振り分けて非同期に実行する。
+
+    小さいファイルと削除は small レーン、閾値以上のファイルは large レーンで
+    処理する。レーンごとにワーカースレッド数を指定できるので、巨大なファイルの
+    ハッシュ計算が小さいファイルの記録を待たせることはない。
+
+    large レーンはファイルをチャンク単位で読み、small レーンに待ちがある間は
+    処理を譲る。ただし譲り続けるのはmax_yield_sec秒までで、
+    それを過ぎると1チャンク分は必ず処理を進める (starvation 対策)。
+
+    同じパスに対して新しいイベントが届いた場合、古い作業は破棄される。
+    ハッシュ計算中の large レーンの作業もチャンクの区切りで中断する。
+    DBへの書き込みは1スレッドずつ行い、古い作業が新しい作業の結果を
+    上書きしないようにする。
+
+    失敗した作業はretry_delay秒ずつ間隔を伸ばしながらmax_retries回まで
+    やり直す。それでも失敗した場合は諦め、dead_letter_pathが指定されていれば
+    そのファイルに1行のJSONとして書き出す。
+    '''
+    def __init__(self, recorder,
+                 *, large_file_threshold=LARGE_FILE_THRESHOLD,
+                 small_lane_workers=2, large_lane_workers=1,
+                 large_lane_bytes_per_sec=0, max_yield_sec=1.0,
+                 max_retries=3, retry_delay=1.0, dead_letter_path=None,
+                 logger=None):
+        self.recorder = recorder
+        self.large_file_threshold = large_file_threshold
+        self.max_yield_sec = max_yield_sec
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.dead_letter_path = dead_letter_path
+        self.logger = logger or _null_logger
+        self.small_lane = _Lane('small', small_lane_workers)
+        self.large_lane = _Lane('large', large_lane_workers,
+                                bytes_per_sec=large_lane_bytes_per_sec)
+        self._cond = threading.Condition()
+        self._record_lock = threading.Lock()
+        self._generation = 0
+        # パスごとに最後に投入された作業のgeneration
+        self._latest = {}
+        # やり直し待ちの作業の数
+        self._retrying = 0
+        self._dead_letter_lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        for lane in (self.small_lane, self.large_lane):
+            for i in range(lane.num_workers):
+                thread = threading.Thread(
+                    target=self._work, args=(lane,),
+                    name='{}-lane-{}'.format(lane.name, i))
+                thread.daemon = True
+                thread.start()
+                lane.threads.append(thread)
+
+    def stop(self):
+        '''\
+        キューに残っている作業 (やり直し待ちを含む) を全て処理してから
+        ワーカーを停止する。
+        '''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for lane in (self.small_lane, self.large_lane):
+            for thread in lane.threads:
+                thread.join()
+            lane.threads = []
+
+    def submit_insert(self, path, *, on_done=None):
+        '''\
+        on_doneが指定されている場合、記録が終わるか
+        新しいイベントで不要になった時点で呼び出す。
+        やり直しても記録できず諦めた場合も呼び出す。
+        '''
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            # 既に削除されている。記録側で扱わせる
+            size = 0
+        if size >= self.large_file_threshold:
+            self._submit('insert', path, self.large_lane, on_done)
+        else:
+            self._submit('insert', path, self.small_lane, on_done)
+
+    def submit_delete(self, path, *, on_done=None):
+        self._submit('delete', path, self.small_lane, on_done)
+
+    def _submit(self, op, path, lane, on_done):
+        with self._cond:
+            self._generation += 1
+            self._latest[path] = self._generation
+            lane.queue.append(WorkItem(op, path, self._generation,
+                                       time.monotonic(), on_done, 0))
+            self._cond.notify_all()
+
+    def _is_stale(self, item):
+        return self._latest.get(item.path) != item.generation
+
+    def _work(self, lane):
+        logger = self.logger
+        while True:
+            with self._cond:
+                while not lane.queue and not (self._stopping
+                                              and not self._retrying):
+                    self._cond.wait()
+                if not lane.queue:
+                    return
+                item = lane.queue.popleft()
+            try:
+                self._process(item, lane)
+            except Exception as e:
+                if item.attempt < self.max_retries:
+                    self._retry(item, lane, e)
+                    continue
+                logger.exception('Gave up {} of "{}" after {} attempt(s)'
+                                 .format(item.op, item.path,
+                                         item.attempt + 1))
+                self._write_dead_letter(item, e)
+            # 諦めた場合も完了扱いにしないと、spoolのウォーターマークが
+            # 進まなくなる
+            if item.on_done:
+                item.on_done()
+            with self._cond:
+                if not self._is_stale(item):
+                    del self._latest[item.path]
+                # large レーンが待っている場合に起こす
+                self._cond.notify_all()
+
+    def _retry(self, item, lane, error):
+        delay = self.retry_delay * (item.attempt + 1)
+        self.logger.warning('Failed to process {} of "{}" ({}).'
+                            ' Retrying in {:.1f} sec'
+                            .format(item.op, item.path, error, delay))
+        with self._cond:
+            self._retrying += 1
+        timer = threading.Timer(delay, self._requeue,
+                                (item._replace(attempt=item.attempt + 1),
+                                 lane))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, item, lane):
+        with self._cond:
+            self._retrying -= 1
+            lane.queue.append(item)
+            self._cond.notify_all()
+
+    def _write_dead_letter(self, item, error):
+        if not self.dead_letter_path:
+            return
+        # パスはUTF-8で表現できない場合もあるのでJSONでエスケープする
+        line = json.dumps({'time': time.time(), 'op': item.op,
+                           'path': item.path, 'error': repr(error)})
+        try:
+            with self._dead_letter_lock:
+                with open(self.dead_letter_path, 'a') as f:
+                    f.write(line + '\n')
+        except OSError:
+            self.logger.exception('Failed to write to "{}"'
+                                  .format(self.dead_letter_path))
+
+    def _process(self, item, lane):
+        logger = self.logger
+        if self._is_stale(item):
+            logger.debug('Skipping {} of "{}" superseded by a newer event'
+                         .format(item.op, item.path))
+            return
+        op = item.op
+        content_digest = None
+        if op == 'insert':
+            try:
+                if lane is self.large_lane:
+                    content_digest = self._calc_digest_preemptibly(item, lane)
+                else:
+                    content_digest = _calc_digest(item.path, logger=logger)
+            except FileNotFoundError:
+                # 記録する前に削除された。spoolの再生時のように削除イベントが
+                # 後から届かない場合もあるので、ここで削除として扱う
+                logger.debug('"{}" no longer exists. Deleting instead'
+                             .format(item.path))
+                op = 'delete'
+            except OSError:
+                # DBRecorderに再度計算させ、失敗した旨を記録させる
+                pass
+        with self._record_lock:
+            if self._is_stale(item):
+                logger.debug('Discarding {} of "{}" superseded by'
+                             ' a newer event'.format(item.op, item.path))
+                return
+            if op == 'insert':
+                self.recorder.insert(item.path,
+                                     content_digest=content_digest)
+            else:
+                self.recorder.delete(item.path)
+        logger.debug('Finished {} of "{}" on {} lane ({:.3f} sec after'
+                     ' the event)'.format(item.op, item.path, lane.name,
+                                          time.monotonic() - item.enqueued))
+
+    def _yield_to_small_lane(self):
+        '''\
+        small レーンに待ちがあれば、最大max_yield_sec秒まで処理を譲る。
+        '''
+        with self._cond:
+            deadline = time.monotonic() + self.max_yield_sec
+            while self.small_lane.queue and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.logger.debug('Large lane yielded for {} sec.'
+                                      ' Proceeding anyway'
+                                      .format(self.max_yield_sec))
+                    return
+                self._cond.wait(remaining)
+
+    def _calc_digest_preemptibly(self, item, lane):
+        logger = self.logger
+        logger.debug('Start calculating hexdigest for {} chunk by chunk'
+                     .format(item.path))
+        h = hashlib.sha256()
+        with open(item.path, 'rb') as f:
+            while True:
+                self._yield_to_small_lane()
+                if self._is_stale(item):
+                    logger.debug('Aborted calculating hexdigest for {}'
+                                 .format(item.path))
+                    return None
+                lane.limiter.acquire(LARGE_DIGEST_CHUNK_SIZE)
+                chunk = f.read(LARGE_DIGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        logger.debug('Finished calculating hexdigest for {}'
+                     .format(item.path))
+        return h.hexdigest()
 
 
 class FSChangeHandler(FileSystemEventHandler):
     def __init__(self, path_to_watch, recorder,
-                 *, logger=None):
+                 *, scheduler=None, spool=None, logger=None):
         self.path_to_watch = path_to_watch
         self.logger = logger or _null_logger
         self.recorder = recorder
+        self.scheduler = scheduler
+        self.spool = spool
+
+    def _spool(self, op, path):
+        '''\
+        spoolがあればイベントを書き込み、記録後にackする関数を返す
+        '''
+        if not self.spool:
+            return None
+        return functools.partial(self.spool.ack, self.spool.append(op, path))
+
+    def _is_spool_path(self, path):
+        # spoolのディレクトリが監視対象の中にある場合、spool自身への
+        # 書き込みを記録するとそのイベントがまたspoolに書かれ、延々と続く
+        return bool(self.spool) and os.path.abspath(path).startswith(
+            self.spool.spool_dir + os.sep)
+
+    def _insert(self, path, *, logger=None):
+        logger = logger or self.logger
+        if self._is_spool_path(path):
+            logger.debug('Modification to spool itself is ignored ({})'
+                         .format(path))
+            return
+        # schedulerがあればwatchdogのスレッドを待たせずに記録を任せる
+        if self.scheduler:
+            self.scheduler.submit_insert(path,
+                                         on_done=self._spool('insert', path))
+        else:
+            self.recorder.insert(path, logger=logger)
+
+    def _delete(self, path, *, logger=None):
+        logger = logger or self.logger
+        if self._is_spool_path(path):
+            logger.debug('Modification to spool itself is ignored ({})'
+                         .format(path))
+            return
+        if self.scheduler:
+            self.scheduler.submit_delete(path,
+                                         on_done=self._spool('delete', path))
+        else:
+            self.recorder.delete(path, logger=logger)
 
     def on_any_event(self, event, logger=None):
         logger = logger or self.logger
@@ -157,7 +518,7 @@ class FSChangeHandler(FileSystemEventHandler):
                          .format(event.src_path, ext))
             return
         logger.info('"{}" has been created.'.format(event.src_path))
-        self.recorder.insert(event.src_path, logger=logger)
+        self._insert(event.src_path, logger=logger)
 
     def on_modified(self, event, logger=None):
         logger = logger or self.logger
@@ -172,7 +533,7 @@ class FSChangeHandler(FileSystemEventHandler):
                          .format(event.src_path, ext))
             return
         logger.info('"{}" has been modified.'.format(event.src_path))
-        self.recorder.insert(event.src_path, logger=logger)
+        self._insert(event.src_path, logger=logger)
 
     def on_deleted(self, event, logger=None):
         logger = logger or self.logger
@@ -187,7 +548,7 @@ class FSChangeHandler(FileSystemEventHandler):
                          .format(event.src_path, ext))
             return
         logger.info('"{}" has been deleted.'.format(event.src_path))
-        self.recorder.delete(event.src_path, logger=logger)
+        self._delete(event.src_path, logger=logger)
 
     def on_moved(self, event, logger=None):
         logger = logger or self.logger
@@ -204,14 +565,14 @@ class FSChangeHandler(FileSystemEventHandler):
                           'to its extension "{}"')
                          .format(event.src_path, ext))
         else:
-            self.recorder.delete(event.src_path, logger=logger)
+            self._delete(event.src_path, logger=logger)
         (_, ext) = os.path.splitext(event.dest_path)
         if ext and ext[1:] not in EXTENSIONS:
             logger.debug(('Ignoring "{}" because it is ignorable according'
                           'to its extension "{}"')
                          .format(event.dest_path, ext))
         else:
-            self.recorder.insert(event.dest_path, logger=logger)
+            self._insert(event.dest_path, logger=logger)
 
 
 def main():
@@ -230,6 +591,60 @@ def main():
                               ' at the end of the execution'))
     parser.add_argument('--drop-table', action='store_true',
                         help=('If true, drop the sqlite3 table at first'))
+    parser.add_argument('--large-file-threshold', type=int,
+                        default=LARGE_FILE_THRESHOLD,
+                        help=('Files at least this size (in bytes) are'
+                              ' hashed on the throttled large lane'))
+    parser.add_argument('--small-lane-workers', type=int, default=2,
+                        help=('Number of workers for small files'))
+    parser.add_argument('--large-lane-workers', type=int, default=1,
+                        help=('Number of workers for large files'))
+    parser.add_argument('--large-lane-bytes-per-sec', type=int, default=0,
+                        help=('Read budget of the large lane in bytes/sec.'
+                              ' 0 means unlimited'))
+    parser.add_argument('--max-yield-sec', type=float, default=1.0,
+                        help=('Max seconds the large lane waits for'
+                              ' the small lane per chunk'))
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help=('Times to retry a failed record before'
+                              ' giving up'))
+    parser.add_argument('--retry-delay', type=float, default=1.0,
+                        help=('Seconds before the first retry. Grows'
+                              ' linearly with each attempt'))
+    parser.add_argument('--dead-letter-path',
+                        help=('Append records given up after retries to'
+                              ' this file as JSON lines'))
+    parser.add_argument('--serve-lookup', metavar='ADDRESS',
+                        help=('Serve lookups over HTTP at ADDRESS.'
+                              ' e.g. unix:/tmp/watchdog2.sock,'
+                              ' 127.0.0.1:8765'))
+    parser.add_argument('--lookup-cache-size', type=int, default=10000,
+                        help=('Number of paths cached by the lookup server'))
+    parser.add_argument('--lookup-pool-size', type=int, default=4,
+                        help=('Number of read-only connections used by'
+                              ' the lookup server'))
+    parser.add_argument('--profile-dir',
+                        help=('Enable profiling hooks and write results to'
+                              ' this directory. SIGUSR1 dumps thread stacks'
+                              ' and runs cProfile, SIGUSR2 takes a'
+                              ' tracemalloc snapshot'))
+    parser.add_argument('--profile-sec', type=float, default=30,
+                        help=('Seconds to run cProfile per trigger'))
+    parser.add_argument('--profile-socket',
+                        help=('Also accept profiling commands at this'
+                              ' unix socket. Requires --profile-dir'))
+    parser.add_argument('--spool-dir',
+                        help=('Spool events to this directory before'
+                              ' recording them. Events not recorded when'
+                              ' the process stopped are replayed on start'))
+    parser.add_argument('--spool-sync-interval', type=float,
+                        default=SYNC_INTERVAL,
+                        help=('Seconds between fsyncs of the spool.'
+                              ' Events arriving within this window may be'
+                              ' lost on a crash'))
+    parser.add_argument('--spool-segment-size', type=int,
+                        default=SEGMENT_SIZE,
+                        help=('Size of a spool segment file in bytes'))
     args = parser.parse_args()
     logger = getLogger(__name__)
     handler = StreamHandler()
@@ -252,9 +667,63 @@ def main():
     recorder = DBRecorder(path_to_sqlite3, path_to_watch,
                           drop_table=args.drop_table,
                           logger=logger)
+    hooks = None
+    if args.profile_dir:
+        hooks = ProfilingHooks(args.profile_dir,
+                               profile_sec=args.profile_sec,
+                               logger=logger)
+        hooks.install_signal_handlers()
+        if args.profile_socket:
+            hooks.serve_control(args.profile_socket)
+    lookup_server = None
+    if args.serve_lookup:
+        lookup_service = LookupService(path_to_sqlite3,
+                                       cache_size=args.lookup_cache_size,
+                                       pool_size=args.lookup_pool_size,
+                                       logger=logger)
+        recorder.lookup_service = lookup_service
+        try:
+            lookup_server = serve(lookup_service, args.serve_lookup)
+        except RuntimeError:
+            # 開いた制御用ソケットを残さない
+            if hooks:
+                hooks.close()
+            raise
+    scheduler = LaneScheduler(
+        recorder,
+        large_file_threshold=args.large_file_threshold,
+        small_lane_workers=args.small_lane_workers,
+        large_lane_workers=args.large_lane_workers,
+        large_lane_bytes_per_sec=args.large_lane_bytes_per_sec,
+        max_yield_sec=args.max_yield_sec,
+        max_retries=args.max_retries,
+        retry_delay=args.retry_delay,
+        dead_letter_path=args.dead_letter_path,
+        logger=logger)
+    scheduler.start()
+    spool = None
+    if args.spool_dir:
+        spool = EventSpool(args.spool_dir,
+                           segment_size=args.spool_segment_size,
+                           sync_interval=args.spool_sync_interval,
+                           logger=logger)
+        for (seq, op, path) in spool.open():
+            on_done = functools.partial(spool.ack, seq)
+            if op == 'insert':
+                scheduler.submit_insert(path, on_done=on_done)
+            else:
+                scheduler.submit_delete(path, on_done=on_done)
     event_handler = FSChangeHandler(path_to_watch,
                                     recorder,
+                                    scheduler=scheduler,
+                                    spool=spool,
                                     logger=logger)
+    if hooks:
+        hooks.wrap_methods(event_handler, 'dispatch')
+        hooks.wrap_methods(scheduler, '_process')
+        if lookup_server:
+            hooks.wrap_methods(lookup_server.service,
+                               'lookup_many', 'list_prefix')
     observer = Observer()
     observer.schedule(event_handler, path_to_watch, recursive=True)
     observer.start()
@@ -264,6 +733,18 @@ def main():
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    logger.info('Waiting for pending records')
+    scheduler.stop()
+    if spool:
+        spool.close()
+    if lookup_server:
+        lookup_server.shutdown()
+        lookup_server.server_close()
+        if args.serve_lookup.startswith('unix:'):
+            os.unlink(lookup_server.server_address)
+        lookup_server.service.close()
+    if hooks:
+        hooks.close()
     if args.print_db_at_end:
         recorder.print_content_to_logger()
     logger.info('Ended')
@@ -20,6 +20,8 @@ import os
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
+from profiling_hooks import ProfilingHooks
+
 _null_logger = getLogger(__name__)
 _null_logger.addHandler(NullHandler())
 
@@ -109,6 +111,16 @@ def main():
                         help=('Path to watch'))
     parser.add_argument('-s', '--show-digest', action='store_true',
                         help='Show hexdigest on file creation/modification')
+    parser.add_argument('--profile-dir',
+                        help=('Enable profiling hooks and write results to'
+                              ' this directory. SIGUSR1 dumps thread stacks'
+                              ' and runs cProfile, SIGUSR2 takes a'
+                              ' tracemalloc snapshot'))
+    parser.add_argument('--profile-sec', type=float, default=30,
+                        help=('Seconds to run cProfile per trigger'))
+    parser.add_argument('--profile-socket',
+                        help=('Also accept profiling commands at this'
+                              ' unix socket. Requires --profile-dir'))
     args = parser.parse_args()
     path_to_watch = os.path.abspath(args.path_to_watch)
 
@@ -128,6 +140,15 @@ def main():
     event_handler = FSChangeHandler(path_to_watch,
                                     logger=logger,
                                     show_digest=args.show_digest)
+    hooks = None
+    if args.profile_dir:
+        hooks = ProfilingHooks(args.profile_dir,
+                               profile_sec=args.profile_sec,
+                               logger=logger)
+        hooks.install_signal_handlers()
+        if args.profile_socket:
+            hooks.serve_control(args.profile_socket)
+        hooks.wrap_methods(event_handler, 'dispatch')
     observer = Observer()
     observer.schedule(event_handler, path_to_watch, recursive=True)
     observer.start()
@@ -137,6 +158,8 @@ def main():
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    if hooks:
+        hooks.close()
 
     logger.info('Ended')
 